@@ -7,9 +7,8 @@ from functools import partial
 import os
 
 import numpy as np
-from scipy import sparse, linalg, stats
-from numpy.testing import (assert_equal, assert_array_equal,
-                           assert_array_almost_equal, assert_allclose)
+from scipy import ndimage, sparse, stats
+from numpy.testing import assert_array_equal, assert_allclose
 import pytest
 
 from mne.fixes import has_numba
@@ -39,32 +38,83 @@ def numba_conditional(monkeypatch, request):
     yield request.param
 
 
+@pytest.fixture(scope='function')
+def threading_backend():
+    """Run parallel permutations in threads to avoid pickling overhead.
+
+    Only safe for the multi-sample tests: the 1-sample permutations can
+    sign-flip the shared data in place.
+    """
+    # same fallback as mne.parallel.parallel_func
+    try:
+        from joblib import parallel_backend
+    except ImportError:
+        try:
+            from sklearn.externals.joblib import parallel_backend
+        except ImportError:  # cannot select a backend, use the default
+            parallel_backend = None
+    if parallel_backend is None:
+        yield
+    else:
+        with parallel_backend('threading'):
+            yield
+
+
 n_space = 50
+# enough permutations to find the (strong) simulated effects and to compare
+# code paths, but not for checking p-value calibration
+n_perm_smoke = 25
 
 
-def _get_conditions():
+@pytest.fixture(scope='session')
+def conditions():
+    """Get the synthetic 1D and 2D conditions shared by the cluster tests."""
     noise_level = 20
     n_time_1 = 20
     n_time_2 = 13
-    normfactor = np.hanning(20).sum()
-    rng = np.random.RandomState(42)
-    condition1_1d = rng.randn(n_time_1, n_space) * noise_level
-    for c in condition1_1d:
-        c[:] = np.convolve(c, np.hanning(20), mode="same") / normfactor
-
-    condition2_1d = rng.randn(n_time_2, n_space) * noise_level
-    for c in condition2_1d:
-        c[:] = np.convolve(c, np.hanning(20), mode="same") / normfactor
+    window = np.hanning(20)
+    normfactor = window.sum()
+    if check_version('numpy', '1.17'):
+        rng = np.random.default_rng(42)
+    else:
+        rng = np.random.RandomState(42)
+    # origin=-1 matches np.convolve(..., mode="same") for an even-length window
+    condition1_1d = rng.standard_normal((n_time_1, n_space)) * noise_level
+    condition1_1d = ndimage.convolve1d(condition1_1d, window, axis=1,
+                                       mode='constant', origin=-1) / normfactor
+
+    condition2_1d = rng.standard_normal((n_time_2, n_space)) * noise_level
+    condition2_1d = ndimage.convolve1d(condition2_1d, window, axis=1,
+                                       mode='constant', origin=-1) / normfactor
 
     pseudoekp = 10 * np.hanning(25)[None, :]
     condition1_1d[:, 25:] += pseudoekp
     condition2_1d[:, 25:] -= pseudoekp
 
+    # single precision is plenty for these and halves the memory traffic
+    condition1_1d = condition1_1d.astype(np.float32)
+    condition2_1d = condition2_1d.astype(np.float32)
+    # these are shared across tests, so make sure nobody modifies them. Note
+    # that unbuffered 1-sample permutations of read-only data take the
+    # copying ``stat_fun(X * signs)`` branch, so runs on ``condition1`` cover
+    # that one and runs on the (writable) ``-condition1`` the in-place one
+    condition1_1d.flags.writeable = False
+    condition2_1d.flags.writeable = False
     condition1_2d = condition1_1d[:, :, np.newaxis]
     condition2_2d = condition2_1d[:, :, np.newaxis]
     return condition1_1d, condition2_1d, condition1_2d, condition2_2d
 
 
+def _cluster_sums(stat, clusters):
+    """Sum the stat values within each cluster (masks or index tuples)."""
+    if isinstance(clusters[0], np.ndarray):
+        masks = np.array(clusters).reshape(len(clusters), -1)
+        return np.dot(masks, stat.ravel())
+    inds = tuple(np.concatenate(ii) for ii in zip(*clusters))
+    starts = np.cumsum([0] + [len(c[0]) for c in clusters[:-1]])
+    return np.add.reduceat(stat[inds], starts)
+
+
 def test_thresholds(numba_conditional):
     """Test automatic threshold calculations."""
     # within subjects
@@ -174,38 +224,43 @@ def test_permutation_step_down_p(numba_conditional):
     t, clusters, p_old, H0 = \
         permutation_cluster_1samp_test(X, threshold=thresh,
                                        step_down_p=0.0)
-    assert_equal(np.sum(p_old < 0.05), 1)  # just spatial cluster
+    assert np.sum(p_old < 0.05) == 1  # just spatial cluster
     p_min = np.min(p_old)
     assert_allclose(p_min, 0.003906, atol=1e-6)
     t, clusters, p_new, H0 = \
         permutation_cluster_1samp_test(X, threshold=thresh,
                                        step_down_p=0.05)
-    assert_equal(np.sum(p_new < 0.05), 2)  # time one rescued
+    assert np.sum(p_new < 0.05) == 2  # time one rescued
     assert np.all(p_old >= p_new)
     p_next = p_new[(p_new > 0.004) & (p_new < 0.05)][0]
     assert_allclose(p_next, 0.015625, atol=1e-6)
 
 
-def test_cluster_permutation_test(numba_conditional):
+@pytest.mark.parametrize('ndim', (1, 2))
+def test_cluster_permutation_test(numba_conditional, conditions, ndim,
+                                  threading_backend):
     """Test cluster level permutations tests."""
-    condition1_1d, condition2_1d, condition1_2d, condition2_2d = \
-        _get_conditions()
-    for condition1, condition2 in zip((condition1_1d, condition1_2d),
-                                      (condition2_1d, condition2_2d)):
-        T_obs, clusters, cluster_p_values, hist = permutation_cluster_test(
-            [condition1, condition2], n_permutations=100, tail=1, seed=1,
-            buffer_size=None)
-        p_min = np.min(cluster_p_values)
-        assert_equal(np.sum(cluster_p_values < 0.05), 1)
-        assert_allclose(p_min, 0.01, atol=1e-6)
-
-        # test with 2 jobs and buffer_size enabled
-        buffer_size = condition1.shape[1] // 10
-        T_obs, clusters, cluster_p_values_buff, hist =\
-            permutation_cluster_test([condition1, condition2],
-                                     n_permutations=100, tail=1, seed=1,
-                                     n_jobs=2, buffer_size=buffer_size)
-        assert_array_equal(cluster_p_values, cluster_p_values_buff)
+    condition1_1d, condition2_1d, condition1_2d, condition2_2d = conditions
+    condition1, condition2 = {1: (condition1_1d, condition2_1d),
+                              2: (condition1_2d, condition2_2d)}[ndim]
+    T_obs, clusters, cluster_p_values, hist = permutation_cluster_test(
+        [condition1, condition2], n_permutations=100, tail=1, seed=1,
+        buffer_size=None)
+    p_min = np.min(cluster_p_values)
+    assert np.sum(cluster_p_values < 0.05) == 1
+    assert_allclose(p_min, 0.01, atol=1e-6)
+
+    # test with 2 jobs and buffer_size enabled; this only checks equivalence
+    # with the serial code, so fewer permutations suffice
+    buffer_size = condition1.shape[1] // 10
+    _, _, cluster_p_values, _ = permutation_cluster_test(
+        [condition1, condition2], n_permutations=n_perm_smoke, tail=1,
+        seed=1, buffer_size=None)
+    T_obs, clusters, cluster_p_values_buff, hist =\
+        permutation_cluster_test([condition1, condition2],
+                                 n_permutations=n_perm_smoke, tail=1, seed=1,
+                                 n_jobs=2, buffer_size=buffer_size)
+    assert_array_equal(cluster_p_values, cluster_p_values_buff)
 
     def stat_fun(X, Y):
         return stats.f_oneway(X, Y)[0]
@@ -215,56 +270,63 @@ def test_cluster_permutation_test(numba_conditional):
                                  stat_fun=stat_fun)
 
 
-def test_cluster_permutation_t_test(numba_conditional):
+@pytest.mark.parametrize('ndim', (1, 2))
+def test_cluster_permutation_t_test_two_tailed(numba_conditional, conditions,
+                                               ndim):
+    """Test two-tailed cluster level permutations T-test."""
+    condition1_1d, condition2_1d, condition1_2d, condition2_2d = conditions
+    condition1 = {1: condition1_1d, 2: condition1_2d}[ndim]
+    # these are so significant we can get away with fewer perms
+    T_obs, clusters, cluster_p_values, hist =\
+        permutation_cluster_1samp_test(condition1, n_permutations=100,
+                                       tail=0, seed=1,
+                                       buffer_size=None)
+    assert np.sum(cluster_p_values < 0.05) == 1
+    p_min = np.min(cluster_p_values)
+    assert_allclose(p_min, 0.01, atol=1e-6)
+
+
+@pytest.mark.parametrize('ndim', (1, 2))
+# use a very large sigma to make sure Ts are not independent
+@pytest.mark.parametrize('sigma', (0., 1e-1))
+def test_cluster_permutation_t_test(numba_conditional, conditions, ndim,
+                                    sigma):
     """Test cluster level permutations T-test."""
-    condition1_1d, condition2_1d, condition1_2d, condition2_2d = \
-        _get_conditions()
-
-    # use a very large sigma to make sure Ts are not independent
-    stat_funs = [ttest_1samp_no_p,
-                 partial(ttest_1samp_no_p, sigma=1e-1)]
-
-    for stat_fun in stat_funs:
-        for condition1, p in ((condition1_1d, 0.01),
-                              (condition1_2d, 0.01)):
-            # these are so significant we can get away with fewer perms
-            T_obs, clusters, cluster_p_values, hist =\
-                permutation_cluster_1samp_test(condition1, n_permutations=100,
-                                               tail=0, seed=1,
-                                               buffer_size=None)
-            assert_equal(np.sum(cluster_p_values < 0.05), 1)
-            p_min = np.min(cluster_p_values)
-            assert_allclose(p_min, p, atol=1e-6)
-
-            T_obs_pos, c_1, cluster_p_values_pos, _ =\
-                permutation_cluster_1samp_test(condition1, n_permutations=100,
-                                               tail=1, threshold=1.67, seed=1,
-                                               stat_fun=stat_fun,
-                                               buffer_size=None)
-
-            T_obs_neg, _, cluster_p_values_neg, _ =\
-                permutation_cluster_1samp_test(-condition1, n_permutations=100,
-                                               tail=-1, threshold=-1.67,
-                                               seed=1, stat_fun=stat_fun,
-                                               buffer_size=None)
-            assert_array_equal(T_obs_pos, -T_obs_neg)
-            assert_array_equal(cluster_p_values_pos < 0.05,
-                               cluster_p_values_neg < 0.05)
-
-            # test with 2 jobs and buffer_size enabled
-            buffer_size = condition1.shape[1] // 10
-            with pytest.warns(None):  # sometimes "independently"
-                T_obs_neg_buff, _, cluster_p_values_neg_buff, _ = \
-                    permutation_cluster_1samp_test(
-                        -condition1, n_permutations=100, tail=-1,
-                        threshold=-1.67, seed=1, n_jobs=2, stat_fun=stat_fun,
-                        buffer_size=buffer_size)
-
-            assert_array_equal(T_obs_neg, T_obs_neg_buff)
-            assert_array_equal(cluster_p_values_neg, cluster_p_values_neg_buff)
-
-
-def test_cluster_permutation_with_connectivity(numba_conditional):
+    condition1_1d, condition2_1d, condition1_2d, condition2_2d = conditions
+    condition1 = {1: condition1_1d, 2: condition1_2d}[ndim]
+    stat_fun = partial(ttest_1samp_no_p, sigma=sigma)
+
+    T_obs_pos, c_1, cluster_p_values_pos, _ =\
+        permutation_cluster_1samp_test(condition1,
+                                       n_permutations=n_perm_smoke,
+                                       tail=1, threshold=1.67, seed=1,
+                                       stat_fun=stat_fun,
+                                       buffer_size=None)
+
+    T_obs_neg, _, cluster_p_values_neg, _ =\
+        permutation_cluster_1samp_test(-condition1,
+                                       n_permutations=n_perm_smoke,
+                                       tail=-1, threshold=-1.67,
+                                       seed=1, stat_fun=stat_fun,
+                                       buffer_size=None)
+    assert_array_equal(T_obs_pos, -T_obs_neg)
+    assert_array_equal(cluster_p_values_pos < 0.05,
+                       cluster_p_values_neg < 0.05)
+
+    # test with 2 jobs and buffer_size enabled against the serial result
+    buffer_size = condition1.shape[1] // 10
+    with pytest.warns(None):  # sometimes "independently"
+        T_obs_neg_buff, _, cluster_p_values_neg_buff, _ = \
+            permutation_cluster_1samp_test(
+                -condition1, n_permutations=n_perm_smoke, tail=-1,
+                threshold=-1.67, seed=1, n_jobs=2, stat_fun=stat_fun,
+                buffer_size=buffer_size)
+
+    assert_array_equal(T_obs_neg, T_obs_neg_buff)
+    assert_array_equal(cluster_p_values_neg, cluster_p_values_neg_buff)
+
+
+def test_cluster_permutation_with_connectivity(numba_conditional, conditions):
     """Test cluster level permutations with connectivity matrix."""
     try:
         try:
@@ -273,15 +335,15 @@ def test_cluster_permutation_with_connectivity(numba_conditional):
             from scikits.learn.feature_extraction.image import grid_to_graph
     except ImportError:
         return
-    condition1_1d, condition2_1d, condition1_2d, condition2_2d = \
-        _get_conditions()
+    condition1_1d, condition2_1d, condition1_2d, condition2_2d = conditions
 
     n_pts = condition1_1d.shape[1]
     # we don't care about p-values in any of these, so do fewer permutations
     args = dict(seed=None, max_step=1, exclude=None,
                 step_down_p=0, t_power=1, threshold=1.67,
-                check_disjoint=False, n_permutations=50)
+                check_disjoint=False, n_permutations=n_perm_smoke)
 
+    connectivity = grid_to_graph(1, n_pts)
     did_warn = False
     for X1d, X2d, func, spatio_temporal_func in \
             [(condition1_1d, condition1_2d,
@@ -292,22 +354,24 @@ def test_cluster_permutation_with_connectivity(numba_conditional):
               permutation_cluster_test,
               spatio_temporal_cluster_test)]:
         out = func(X1d, **args)
-        connectivity = grid_to_graph(1, n_pts)
         out_connectivity = func(X1d, connectivity=connectivity, **args)
         assert_array_equal(out[0], out_connectivity[0])
-        for a, b in zip(out_connectivity[1], out[1]):
-            assert_array_equal(out[0][a], out[0][b])
-            assert np.all(a[b])
+        # without connectivity we get slices, with it we get boolean masks
+        starts, stops = np.array([(c[0].start, c[0].stop)
+                                  for c in out[1]]).T
+        pts = np.arange(n_pts)
+        masks = ((pts >= starts[:, np.newaxis]) &
+                 (pts < stops[:, np.newaxis]))
+        assert_array_equal(np.array(out_connectivity[1]), masks)
 
         # test spatio-temporal w/o time connectivity (repeat spatial pattern)
-        connectivity_2 = sparse.coo_matrix(
-            linalg.block_diag(connectivity.asfptype().todense(),
-                              connectivity.asfptype().todense()))
+        connectivity_2 = sparse.block_diag([connectivity, connectivity],
+                                           format='coo')
 
         if isinstance(X1d, list):
-            X1d_2 = [np.concatenate((x, x), axis=1) for x in X1d]
+            X1d_2 = [np.tile(x, (1, 2)) for x in X1d]
         else:
-            X1d_2 = np.concatenate((X1d, X1d), axis=1)
+            X1d_2 = np.tile(X1d, (1, 2))
 
         out_connectivity_2 = func(X1d_2, connectivity=connectivity_2, **args)
         # make sure we were operating on the same values
@@ -319,20 +383,20 @@ def test_cluster_permutation_with_connectivity(numba_conditional):
         n_clust_orig = len(out[1])
         assert len(out_connectivity_2[1]) == 2 * n_clust_orig
 
-        # Make sure that we got the old ones back
-        data_1 = {np.sum(out[0][b[:n_pts]]) for b in out[1]}
-        data_2 = {np.sum(out_connectivity_2[0][a]) for a in
-                  out_connectivity_2[1][:]}
-        assert len(data_1.intersection(data_2)) == len(data_1)
+        # Make sure that we got the old ones back (the masks in
+        # out_connectivity[1] match the slices in out[1], see above)
+        data_1 = _cluster_sums(out[0], out_connectivity[1])
+        data_2 = _cluster_sums(out_connectivity_2[0], out_connectivity_2[1])
+        assert np.isclose(data_1[:, np.newaxis], data_2).any(axis=1).all()
 
-        # now use the other algorithm
+        # now use the other algorithm (reshaping X1d_2 does not copy)
         if isinstance(X1d, list):
             X1d_3 = [np.reshape(x, (-1, 2, n_space)) for x in X1d_2]
         else:
             X1d_3 = np.reshape(X1d_2, (-1, 2, n_space))
 
         out_connectivity_3 = spatio_temporal_func(
-            X1d_3, n_permutations=50, connectivity=connectivity,
+            X1d_3, n_permutations=n_perm_smoke, connectivity=connectivity,
             max_step=0, threshold=1.67, check_disjoint=True)
         # make sure we were operating on the same values
         split = len(out[0])
@@ -343,32 +407,29 @@ def test_cluster_permutation_with_connectivity(numba_conditional):
         assert len(out_connectivity_3[1]) == 2 * n_clust_orig
 
         # Make sure that we got the old ones back
-        data_1 = {np.sum(out[0][b[:n_pts]]) for b in out[1]}
-        data_2 = {np.sum(out_connectivity_3[0][a[0], a[1]]) for a in
-                  out_connectivity_3[1]}
-        assert len(data_1.intersection(data_2)) == len(data_1)
+        data_2 = _cluster_sums(out_connectivity_3[0], out_connectivity_3[1])
+        assert np.isclose(data_1[:, np.newaxis], data_2).any(axis=1).all()
 
         # test new versus old method
         out_connectivity_4 = spatio_temporal_func(
-            X1d_3, n_permutations=50, connectivity=connectivity,
+            X1d_3, n_permutations=n_perm_smoke, connectivity=connectivity,
             max_step=2, threshold=1.67)
         out_connectivity_5 = spatio_temporal_func(
-            X1d_3, n_permutations=50, connectivity=connectivity,
+            X1d_3, n_permutations=n_perm_smoke, connectivity=connectivity,
             max_step=1, threshold=1.67)
 
         # clusters could be in a different order
-        sums_4 = [np.sum(out_connectivity_4[0][a])
-                  for a in out_connectivity_4[1]]
-        sums_5 = [np.sum(out_connectivity_4[0][a])
-                  for a in out_connectivity_5[1]]
-        sums_4 = np.sort(sums_4)
-        sums_5 = np.sort(sums_5)
-        assert_array_almost_equal(sums_4, sums_5)
+        sums_4 = np.sort(_cluster_sums(out_connectivity_4[0],
+                                       out_connectivity_4[1]))
+        sums_5 = np.sort(_cluster_sums(out_connectivity_4[0],
+                                       out_connectivity_5[1]))
+        assert_allclose(sums_4, sums_5, rtol=1e-6)
 
         if not _force_serial:
-            pytest.raises(ValueError, spatio_temporal_func, X1d_3,
-                          n_permutations=1, connectivity=connectivity,
-                          max_step=1, threshold=1.67, n_jobs=-1000)
+            with pytest.raises(ValueError, match='n_jobs'):
+                spatio_temporal_func(
+                    X1d_3, n_permutations=1, connectivity=connectivity,
+                    max_step=1, threshold=1.67, n_jobs=-1000)
 
         # not enough TFCE params
         with pytest.raises(KeyError, match='threshold, if dict, must have'):
@@ -394,12 +455,12 @@ def test_cluster_permutation_with_connectivity(numba_conditional):
         bad_con = connectivity.todense()
         with pytest.raises(ValueError, match='must be a SciPy sparse matrix'):
             spatio_temporal_func(
-                X1d_3, n_permutations=50, connectivity=bad_con,
+                X1d_3, n_permutations=n_perm_smoke, connectivity=bad_con,
                 max_step=1, threshold=1.67)
         bad_con = connectivity.tocsr()[:-1, :-1].tocoo()
         with pytest.raises(ValueError, match='connectivity.*the correct size'):
             spatio_temporal_func(
-                X1d_3, n_permutations=50, connectivity=bad_con,
+                X1d_3, n_permutations=n_perm_smoke, connectivity=bad_con,
                 max_step=1, threshold=1.67)
         with pytest.raises(TypeError, match='must be a'):
             spatio_temporal_func(
@@ -410,11 +471,9 @@ def test_cluster_permutation_with_connectivity(numba_conditional):
                     X1d_3, connectivity=connectivity, tail=2)
 
         # make sure it actually found a significant point
-        out_connectivity_6 = spatio_temporal_func(X1d_3, n_permutations=50,
-                                                  connectivity=connectivity,
-                                                  max_step=1,
-                                                  threshold=dict(start=1,
-                                                                 step=1))
+        out_connectivity_6 = spatio_temporal_func(
+            X1d_3, n_permutations=n_perm_smoke, connectivity=connectivity,
+            max_step=1, threshold=dict(start=1, step=1))
         assert np.min(out_connectivity_6[2]) < 0.05
 
 
@@ -427,47 +486,55 @@ def test_permutation_connectivity_equiv(numba_conditional):
             from scikits.learn.feature_extraction.image import grid_to_graph
     except ImportError:
         return
-    rng = np.random.RandomState(0)
+    if check_version('numpy', '1.17'):
+        rng = np.random.default_rng(0)
+    else:
+        rng = np.random.RandomState(0)
     # subjects, time points, spatial points
     n_time = 2
     n_space = 4
-    X = rng.randn(6, n_time, n_space)
+    X = rng.standard_normal((6, n_time, n_space))
     # add some significant points
     X[:, :, 0:2] += 10  # span two time points and two spatial points
     X[:, 1, 3] += 20  # span one time point
     max_steps = [1, 1, 1, 2, 1]
     # This will run full algorithm in two ways, then the ST-algorithm in 2 ways
     # All of these should give the same results
+    conn_space = grid_to_graph(1, n_space)
     conns = [None,
              grid_to_graph(n_time, n_space),
-             grid_to_graph(1, n_space),
-             grid_to_graph(1, n_space),
+             conn_space,
+             conn_space,
              None]
     stat_map = None
     thresholds = [2, 2, 2, 2, dict(start=0.01, step=1.0)]
     sig_counts = [2, 2, 2, 2, 5]
+    # the non-TFCE results are all compared to the first (serial) run, so
+    # running the full and spatio-temporal connectivity cases in parallel
+    # checks those parallel paths against the serial one
+    n_jobss = [1, 2, 1, 2, 1]
     stat_fun = partial(ttest_1samp_no_p, sigma=1e-3)
 
     cs = None
     ps = None
-    for thresh, count, max_step, conn in zip(thresholds, sig_counts,
-                                             max_steps, conns):
+    for thresh, count, max_step, conn, n_jobs in zip(
+            thresholds, sig_counts, max_steps, conns, n_jobss):
         t, clusters, p, H0 = \
             permutation_cluster_1samp_test(
-                X, threshold=thresh, connectivity=conn, n_jobs=2,
+                X, threshold=thresh, connectivity=conn, n_jobs=n_jobs,
                 max_step=max_step, stat_fun=stat_fun, seed=0)
         # make sure our output datatype is correct
         assert isinstance(clusters[0], np.ndarray)
         assert clusters[0].dtype == bool
-        assert_array_equal(clusters[0].shape, X.shape[1:])
+        assert clusters[0].shape == X.shape[1:]
 
         # make sure all comparisons were done; for TFCE, no perm
         # should come up empty
         inds = np.where(p < 0.05)[0]
-        assert_equal(len(inds), count)
+        assert len(inds) == count
         assert_allclose(p[inds], 0.03125, atol=1e-6)
         if isinstance(thresh, dict):
-            assert_equal(len(clusters), n_time * n_space)
+            assert len(clusters) == n_time * n_space
             assert np.all(H0 != 0)
             continue
         this_cs = [clusters[ii] for ii in inds]
@@ -490,11 +557,12 @@ def test_permutation_connectivity_equiv(numba_conditional):
         assert_array_equal(ps, this_ps)
         assert len(cs) == len(this_cs)
         for c1, c2 in zip(cs, this_cs):
-            assert_array_equal(c1, c2)
+            assert (c1 == c2).all()
         assert_array_equal(stat_map, this_stat_map)
 
 
-def test_spatio_temporal_cluster_connectivity(numba_conditional):
+def test_spatio_temporal_cluster_connectivity(numba_conditional, conditions,
+                                              threading_backend):
     """Test spatio-temporal cluster permutations."""
     try:
         try:
@@ -503,8 +571,7 @@ def test_spatio_temporal_cluster_connectivity(numba_conditional):
             from scikits.learn.feature_extraction.image import grid_to_graph
     except ImportError:
         return
-    condition1_1d, condition2_1d, condition1_2d, condition2_2d = \
-        _get_conditions()
+    condition1_1d, condition2_1d, condition1_2d, condition2_2d = conditions
 
     rng = np.random.RandomState(0)
     noise1_2d = rng.randn(condition1_2d.shape[0], condition1_2d.shape[1], 10)
@@ -518,36 +585,35 @@ def test_spatio_temporal_cluster_connectivity(numba_conditional):
     threshold = dict(start=4.0, step=2)
     T_obs, clusters, p_values_conn, hist = \
         spatio_temporal_cluster_test([data1_2d, data2_2d], connectivity=conn,
-                                     n_permutations=50, tail=1, seed=1,
-                                     threshold=threshold, buffer_size=None)
+                                     n_permutations=n_perm_smoke, tail=1,
+                                     seed=1, threshold=threshold,
+                                     buffer_size=None)
 
     buffer_size = data1_2d.size // 10
     T_obs, clusters, p_values_no_conn, hist = \
         spatio_temporal_cluster_test([data1_2d, data2_2d],
-                                     n_permutations=50, tail=1, seed=1,
-                                     threshold=threshold, n_jobs=2,
+                                     n_permutations=n_perm_smoke, tail=1,
+                                     seed=1, threshold=threshold, n_jobs=2,
                                      buffer_size=buffer_size)
 
-    assert_equal(np.sum(p_values_conn < 0.05), np.sum(p_values_no_conn < 0.05))
+    assert np.sum(p_values_conn < 0.05) == np.sum(p_values_no_conn < 0.05)
 
     # make sure results are the same without buffer_size
     T_obs, clusters, p_values2, hist2 = \
         spatio_temporal_cluster_test([data1_2d, data2_2d],
-                                     n_permutations=50, tail=1, seed=1,
-                                     threshold=threshold, n_jobs=2,
+                                     n_permutations=n_perm_smoke, tail=1,
+                                     seed=1, threshold=threshold, n_jobs=2,
                                      buffer_size=None)
     assert_array_equal(p_values_no_conn, p_values2)
-    pytest.raises(ValueError, spatio_temporal_cluster_test,
-                  [data1_2d, data2_2d], tail=1, threshold=-2.)
-    pytest.raises(ValueError, spatio_temporal_cluster_test,
-                  [data1_2d, data2_2d], tail=-1, threshold=2.)
-    pytest.raises(ValueError, spatio_temporal_cluster_test,
-                  [data1_2d, data2_2d], tail=0, threshold=-1)
-
-
-def ttest_1samp(X):
-    """Return T-values."""
-    return stats.ttest_1samp(X, 0)[0]
+    with pytest.raises(ValueError, match='incompatible tail and threshold'):
+        spatio_temporal_cluster_test([data1_2d, data2_2d], tail=1,
+                                     threshold=-2.)
+    with pytest.raises(ValueError, match='incompatible tail and threshold'):
+        spatio_temporal_cluster_test([data1_2d, data2_2d], tail=-1,
+                                     threshold=2.)
+    with pytest.raises(ValueError, match='incompatible tail and threshold'):
+        spatio_temporal_cluster_test([data1_2d, data2_2d], tail=0,
+                                     threshold=-1)
 
 
 def test_summarize_clusters():
@@ -559,7 +625,8 @@ def test_summarize_clusters():
     stc_sum = summarize_clusters_stc(clu)
     assert stc_sum.data.shape[1] == 2
     clu[2][0] = 0.3
-    pytest.raises(RuntimeError, summarize_clusters_stc, clu)
+    with pytest.raises(RuntimeError, match='No significant clusters'):
+        summarize_clusters_stc(clu)
 
 
 def test_permutation_test_H0(numba_conditional):
@@ -569,19 +636,19 @@ def test_permutation_test_H0(numba_conditional):
     with pytest.warns(RuntimeWarning, match='No clusters found'):
         t, clust, p, h0 = spatio_temporal_cluster_1samp_test(
             data, threshold=100, n_permutations=1024, seed=rng)
-    assert_equal(len(h0), 0)
+    assert len(h0) == 0
 
     for n_permutations in (1024, 65, 64, 63):
         t, clust, p, h0 = spatio_temporal_cluster_1samp_test(
             data, threshold=0.1, n_permutations=n_permutations, seed=rng)
-        assert_equal(len(h0), min(n_permutations, 64))
+        assert len(h0) == min(n_permutations, 64)
         assert isinstance(clust[0], tuple)  # sets of indices
     for tail, thresh in zip((-1, 0, 1), (-0.1, 0.1, 0.1)):
         t, clust, p, h0 = spatio_temporal_cluster_1samp_test(
             data, threshold=thresh, seed=rng, tail=tail, out_type='mask')
         assert isinstance(clust[0], np.ndarray)  # bool mask
         # same as "128 if tail else 64"
-        assert_equal(len(h0), 2 ** (7 - (tail == 0)))  # exact test
+        assert len(h0) == 2 ** (7 - (tail == 0))  # exact test
 
 
 def test_tfce_thresholds(numba_conditional):
@@ -590,15 +657,17 @@ def test_tfce_thresholds(numba_conditional):
     data = rng.randn(7, 10, 1) - 0.5
 
     # if tail==-1, step must also be negative
-    pytest.raises(ValueError, permutation_cluster_1samp_test, data, tail=-1,
-                  threshold=dict(start=0, step=0.1))
+    with pytest.raises(ValueError, match=r'"step"\] must be < 0'):
+        permutation_cluster_1samp_test(data, tail=-1,
+                                       threshold=dict(start=0, step=0.1))
     # this works (smoke test)
     permutation_cluster_1samp_test(data, tail=-1,
                                    threshold=dict(start=0, step=-0.1))
 
     # thresholds must be monotonically increasing
-    pytest.raises(ValueError, permutation_cluster_1samp_test, data, tail=1,
-                  threshold=dict(start=1, step=-0.5))
+    with pytest.raises(ValueError, match='monotonically increasing'):
+        permutation_cluster_1samp_test(data, tail=1,
+                                       threshold=dict(start=1, step=-0.5))
 
 
 run_tests_if_main()